@@ -3,24 +3,113 @@ import pdb
 import json
 import os
 import io
-import requests
-import traceback
 import linecache
+import threading
+import time
+import types
 import reprlib  # Essential for production: handles massive objects safely
+from collections import OrderedDict
 from dataclasses import dataclass
 from typing import List, Dict, Any, Optional
 
+try:
+    import orjson  # Optional: C-accelerated JSON for snapshot serialization
+except ImportError:
+    orjson = None
+
 # --- Configuration & Environment ---
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Config:
     OLLAMA_URL: str = os.getenv("OLLAMA_URL", "http://localhost:11434/api/generate")
     MODEL: str = os.getenv("AID_MODEL", "qwen3:8b")  # Default to a capable model
     CONTEXT_SIZE: int = int(os.getenv("AID_CONTEXT_SIZE", "4096"))
+    # How long Ollama keeps the model loaded after a request ("30m", "1h", or -1 to pin it)
+    KEEP_ALIVE: str = os.getenv("AID_KEEP_ALIVE", "30m")
+    # Gzip request bodies; only enable behind a proxy that inflates them (Ollama itself does not)
+    GZIP_REQUESTS: bool = os.getenv("AID_GZIP_REQUESTS", "0") == "1"
+    # Trusted local/CI use only: run LLM-suggested Pdb commands without asking
+    AUTO_APPROVE: bool = os.getenv("AID_AUTO_APPROVE", "0") == "1"
     # Safety: Limit variable size in logs to prevent blowing up the LLM context window
     MAX_VAR_LEN: int = 500 
 
 config = Config()
 
+# Shared truncating repr, configured once from MAX_VAR_LEN
+_SAFE_REPR = reprlib.Repr()
+_SAFE_REPR.maxstring = config.MAX_VAR_LEN
+_SAFE_REPR.maxother = config.MAX_VAR_LEN
+
+# Locals that only add noise to the prompt (imports, helpers, class objects)
+_SKIP_LOCAL_TYPES = (types.ModuleType, types.FunctionType, type)
+
+def _apply_var_budget(local_vars: Dict[str, str]) -> Dict[str, str]:
+    """
+    Keeps variables (in frame order) until ~60% of the context window is used,
+    assuming ~4 bytes per token, so Ollama never silently truncates the prompt.
+    """
+    budget = int(0.6 * config.CONTEXT_SIZE * 4)
+    kept, total = {}, 0
+    for k, v in local_vars.items():
+        total += len(k) + len(v)
+        if total > budget:
+            break
+        kept[k] = v
+    omitted = len(local_vars) - len(kept)
+    if omitted:
+        kept["__truncated__"] = f"omitted {omitted} vars"
+    return kept
+
+def _keep_alive_value(value: str):
+    """Ollama expects bare numbers (e.g. -1) as JSON numbers, durations as strings."""
+    return int(value) if value.lstrip("-").isdigit() else value
+
+def _json_dumps(obj) -> str:
+    """Compact JSON encoding, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(",", ":"))
+
+def _json_loads(data):
+    """JSON decoding, using orjson when it is installed (both raise json.JSONDecodeError)."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _request_body(payload: dict) -> dict:
+    """Builds the `requests` keyword arguments carrying the JSON payload."""
+    if config.GZIP_REQUESTS:
+        import gzip
+        return {
+            "data": gzip.compress(_json_dumps(payload).encode()),
+            "headers": {"Content-Encoding": "gzip", "Content-Type": "application/json"}
+        }
+    return {"json": payload}
+
+# --- Shared HTTP Session ---
+# A single pooled session keeps the socket to Ollama alive between `ai` calls,
+# so only the first query pays the TCP handshake. It is created on first use so
+# that importing cognitrace does not pay for importing `requests`.
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+def _get_session():
+    """Returns the shared session, or None (after logging) if `requests` is not installed."""
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            try:
+                import requests
+                from requests.adapters import HTTPAdapter
+            except ImportError:
+                log_err("The 'requests' package is missing. (run `pip install requests`)")
+                return None
+            session = requests.Session()
+            session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=0))
+            session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=0))
+            session.headers.update({"Connection": "keep-alive", "Accept-Encoding": "gzip"})
+            _SESSION = session
+        return _SESSION
+
 # --- Utility: Safe Output ---
 class Colors:
     HEADER = '\033[95m'
@@ -32,48 +121,123 @@ class Colors:
     ENDC = '\033[0m'
     BOLD = '\033[1m'
 
-def log_info(msg): print(f"{Colors.OKCYAN}[AI-DEBUG]{Colors.ENDC} {msg}")
-def log_warn(msg): print(f"{Colors.WARNING}[AI-DEBUG WARN]{Colors.ENDC} {msg}")
-def log_err(msg): print(f"{Colors.FAIL}[AI-DEBUG ERROR]{Colors.ENDC} {msg}")
+# Prefixes and banners are built once instead of on every call
+_INFO_PREFIX = f"{Colors.OKCYAN}[AI-DEBUG]{Colors.ENDC}"
+_WARN_PREFIX = f"{Colors.WARNING}[AI-DEBUG WARN]{Colors.ENDC}"
+_ERR_PREFIX = f"{Colors.FAIL}[AI-DEBUG ERROR]{Colors.ENDC}"
+_DIAGNOSIS_HEADER = f"\n{Colors.HEADER}=== 🧠 AI DIAGNOSIS ==={Colors.ENDC}"
+_DIAGNOSIS_FOOTER = f"{Colors.HEADER}======================={Colors.ENDC}\n"
+
+def log_info(msg): print(_INFO_PREFIX, msg)
+def log_warn(msg): print(_WARN_PREFIX, msg)
+def log_err(msg): print(_ERR_PREFIX, msg)
 
 # --- Core Service: Ollama Integration ---
 
-def query_ollama(prompt_context: dict, user_query: str) -> dict:
+# Context Pruning: We only send what's necessary to save tokens/time
+_SYSTEM_PROMPT = (
+    "You are an advanced Python Debugging Agent (Level 15). "
+    "You have access to the current stack trace, local variables, and code snippet. "
+    "Analyze the Root Cause and provide a Fix. "
+    "If you need to verify assumptions, suggest specific Pdb commands. "
+    "Response MUST be valid JSON with keys: 'diagnosis', 'suggested_fix', 'pdb_commands'."
+)
+
+_PROMPT_TEMPLATE = _SYSTEM_PROMPT + (
+    "\n\n--- SNAPSHOT ---\n"
+    "Error: %s\n"
+    "Function: %s\n"
+    "Line: %s\n"
+    "Code Context:\n%s\n\n"
+    "Variables:\n%s\n\n"
+    "--- USER QUERY ---\n%s\n"
+)
+
+# Diagnoses already produced for a (frame, query) pair; errors are never cached
+_DIAGNOSIS_CACHE: "OrderedDict[tuple, dict]" = OrderedDict()
+_DIAGNOSIS_CACHE_SIZE = 32
+_DIAGNOSIS_CACHE_LOCK = threading.Lock()
+
+# Circuit breaker: after repeated connection failures, skip snapshot + request for a while
+_BREAKER = {"failures": 0, "opened_at": 0.0}
+_BREAKER_THRESHOLD = 3
+_BREAKER_COOLDOWN = 30.0
+# ai_bg workers update the breaker concurrently with the debugger thread
+_BREAKER_LOCK = threading.Lock()
+
+def _breaker_remaining() -> float:
+    """Seconds left before Ollama is tried again, or 0 if queries may proceed."""
+    with _BREAKER_LOCK:
+        if _BREAKER["failures"] < _BREAKER_THRESHOLD:
+            return 0.0
+        return max(0.0, _BREAKER_COOLDOWN - (time.monotonic() - _BREAKER["opened_at"]))
+
+def _breaker_record(connected: bool):
+    """Counts consecutive connection failures; any HTTP response resets the count."""
+    with _BREAKER_LOCK:
+        if connected:
+            _BREAKER["failures"] = 0
+            return
+        _BREAKER["failures"] += 1
+        if _BREAKER["failures"] >= _BREAKER_THRESHOLD:
+            _BREAKER["opened_at"] = time.monotonic()
+
+def _cache_get(key: tuple) -> Optional[dict]:
+    with _DIAGNOSIS_CACHE_LOCK:
+        analysis = _DIAGNOSIS_CACHE.get(key)
+        if analysis is not None:
+            _DIAGNOSIS_CACHE.move_to_end(key)
+        return analysis
+
+def _cache_put(key: tuple, analysis: dict) -> dict:
+    with _DIAGNOSIS_CACHE_LOCK:
+        _DIAGNOSIS_CACHE[key] = analysis
+        _DIAGNOSIS_CACHE.move_to_end(key)
+        if len(_DIAGNOSIS_CACHE) > _DIAGNOSIS_CACHE_SIZE:
+            _DIAGNOSIS_CACHE.popitem(last=False)
+    return analysis
+
+def query_ollama(prompt_context: dict, user_query: str, echo: bool = True) -> dict:
     """
     Sends a streamlined, production-optimized prompt to the local Ollama instance.
+    With echo=False (background queries) nothing but errors is printed.
+    Repeating a query on an unchanged frame returns the cached diagnosis.
     """
+    session = _get_session()
+    if session is None:
+        return {"diagnosis": "Error: 'requests' is not installed", "suggested_fix": "pip install requests", "pdb_commands": []}
+    import requests
     
-    # Context Pruning: We only send what's necessary to save tokens/time
-    system_prompt = (
-        "You are an advanced Python Debugging Agent (Level 15). "
-        "You have access to the current stack trace, local variables, and code snippet. "
-        "Analyze the Root Cause and provide a Fix. "
-        "If you need to verify assumptions, suggest specific Pdb commands. "
-        "Response MUST be valid JSON with keys: 'diagnosis', 'suggested_fix', 'pdb_commands'."
-    )
-
-    full_prompt = f"""
-    {system_prompt}
-    
-    --- SNAPSHOT ---
-    Error: {prompt_context.get('exception_str', 'None')}
-    Function: {prompt_context.get('function')}
-    Line: {prompt_context.get('line_number')}
-    Code Context:
-    {prompt_context.get('source_code_snippet')}
+    vars_json = _json_dumps(prompt_context.get('local_variables'))
     
-    Variables:
-    {json.dumps(prompt_context.get('local_variables'), indent=2)}
+    cache_key = (
+        prompt_context.get('filename'),
+        prompt_context.get('line_number'),
+        prompt_context.get('exception_str'),
+        hash(vars_json),
+        user_query
+    )
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        if echo:
+            log_info("Frame unchanged since the last identical query; reusing its diagnosis.")
+        return cached
     
-    --- USER QUERY ---
-    {user_query}
-    """
+    full_prompt = _PROMPT_TEMPLATE % (
+        prompt_context.get('exception_str', 'None'),
+        prompt_context.get('function'),
+        prompt_context.get('line_number'),
+        prompt_context.get('source_code_snippet'),
+        vars_json,
+        user_query
+    )
 
     payload = {
         "model": config.MODEL,
         "prompt": full_prompt,
-        "stream": False,
+        "stream": True, # Tokens are echoed as they arrive instead of after full generation
         "format": "json", # Forces Ollama to output parseable JSON
+        "keep_alive": _keep_alive_value(config.KEEP_ALIVE), # Keep the model resident between prompts
         "options": {
             "num_ctx": config.CONTEXT_SIZE,
             "temperature": 0.2 # Low temp for analytical precision
@@ -81,29 +245,95 @@ def query_ollama(prompt_context: dict, user_query: str) -> dict:
     }
 
     try:
-        log_info(f"Connecting to {config.OLLAMA_URL} using model '{config.MODEL}'...")
-        response = requests.post(config.OLLAMA_URL, json=payload, timeout=480)
-        response.raise_for_status()
+        if echo:
+            log_info(f"Connecting to {config.OLLAMA_URL} using model '{config.MODEL}'...")
+        with session.post(config.OLLAMA_URL, timeout=480, stream=True, **_request_body(payload)) as response:
+            # Any HTTP response, even an error status, means Ollama is reachable
+            _breaker_record(connected=True)
+            response.raise_for_status()
+            
+            # Ollama streams one JSON object per line; assemble the model output incrementally.
+            # Lines stay raw bytes: both orjson and json parse them without a str decode first.
+            # The body is read to EOF (Ollama ends it right after the `done` chunk) so the
+            # connection goes back to the pool instead of being dropped.
+            chunks = []
+            done = False
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                chunk = _json_loads(line)
+                if "error" in chunk:
+                    raise RuntimeError(chunk["error"])
+                token = chunk.get("response", "")
+                chunks.append(token)
+                if echo:
+                    print(token, end="", flush=True)
+                done = done or bool(chunk.get("done"))
+        if echo:
+            print()
         
-        result_text = response.json().get("response", "")
+        result_text = "".join(chunks)
         # Robust JSON parsing handling
         try:
-            return json.loads(result_text)
+            analysis = _json_loads(result_text)
         except json.JSONDecodeError:
-            # Fallback if model chats instead of returning JSON
+            analysis = None
+        
+        if not isinstance(analysis, dict):
+            # Fallback if model chats instead of returning JSON; not cached so `ai` retries
             return {
                 "diagnosis": result_text,
                 "suggested_fix": "Could not parse specific fix from model output.",
                 "pdb_commands": []
             }
+        # Only complete answers are cached; a stream cut off before `done` is retried
+        return _cache_put(cache_key, analysis) if done else analysis
 
     except requests.exceptions.ConnectionError:
+        _breaker_record(connected=False)
         log_err("Could not connect to Ollama. Is it running? (run `ollama serve`)")
         return {"diagnosis": "Connection Error", "suggested_fix": "Start Ollama", "pdb_commands": []}
     except Exception as e:
         log_err(f"LLM Error: {e}")
         return {"diagnosis": f"Error: {str(e)}", "suggested_fix": "N/A", "pdb_commands": []}
 
+def _warmup():
+    """
+    Opens the pooled connection and loads the model into memory in the background,
+    so the first `ai` call is as fast as the ones after it.
+    """
+    try:
+        session = _get_session()
+        if session is None:
+            return
+        session.get(config.OLLAMA_URL.replace("/api/generate", "/api/tags"), timeout=5)
+        # An empty prompt only loads the model; Ollama returns without generating
+        session.post(config.OLLAMA_URL, json={
+            "model": config.MODEL,
+            "prompt": "",
+            "keep_alive": _keep_alive_value(config.KEEP_ALIVE)
+        }, timeout=480)
+    except Exception:
+        # Warmup is best-effort: connection errors are reported by the real query
+        pass
+
+def _run_in_background(fn, *args):
+    """
+    Runs fn on a daemon thread and returns a Future for its result. Unlike a
+    ThreadPoolExecutor, a query still in flight does not hold up interpreter exit.
+    """
+    from concurrent.futures import Future
+    future = Future()
+
+    def runner():
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=runner, daemon=True, name="cognitrace-ai-bg").start()
+    return future
+
 # --- The Agent ---
 
 class AIDebugAgent(pdb.Pdb):
@@ -111,6 +341,11 @@ class AIDebugAgent(pdb.Pdb):
         super().__init__(*args, **kwargs)
         # Register the command alias 'ai' for ease of use
         self.prompt = f"{Colors.OKBLUE}(Pdb-AI){Colors.ENDC} "
+        # Warm up Ollama while the developer is still reading the stack
+        threading.Thread(target=_warmup, daemon=True).start()
+        # Background analyses started with `ai_bg`: (id, query, frame, line, future) tuples
+        self._pending = []
+        self._next_analysis_id = 1
 
     def do_ai(self, arg):
         """
@@ -118,13 +353,75 @@ class AIDebugAgent(pdb.Pdb):
         Analyze the current state with the LLM. If no query is provided, performs a Root Cause Analysis.
         """
         user_query = arg.strip() or "Analyze the root cause of the current state/error."
+        if self._ollama_unavailable():
+            return
         
         snapshot = self._capture_safe_context()
         
         log_info("Thinking... (Analyzing Stack & Variables)")
         analysis = query_ollama(snapshot, user_query)
         
-        print(f"\n{Colors.HEADER}=== 🧠 AI DIAGNOSIS ==={Colors.ENDC}")
+        self._show_analysis(analysis)
+
+    def do_ai_bg(self, arg):
+        """
+        Usage: ai_bg [query]
+        Like 'ai', but runs the analysis in the background so you can keep debugging.
+        Collect the result with 'ai_status'.
+        """
+        user_query = arg.strip() or "Analyze the root cause of the current state/error."
+        if self._ollama_unavailable():
+            return
+        
+        # The snapshot must be taken here, on the debugger thread, while the frame is current
+        snapshot = self._capture_safe_context()
+        
+        future = _run_in_background(query_ollama, snapshot, user_query, False)
+        analysis_id = self._next_analysis_id
+        self._next_analysis_id += 1
+        self._pending.append((analysis_id, user_query, self.curframe, snapshot["line_number"], future))
+        log_info(f"Analysis #{analysis_id} queued. Use 'ai_status' to collect it.")
+
+    def do_ai_status(self, arg):
+        """
+        Usage: ai_status
+        Show finished background analyses started with 'ai_bg' and list the ones still running.
+        """
+        if not self._pending:
+            log_info("No background analyses pending.")
+            return
+        
+        still_running = []
+        for entry in self._pending:
+            analysis_id, user_query, frame, line_number, future = entry
+            if future.done():
+                log_info(f"Result #{analysis_id} for: {user_query}")
+                # Suggested commands were written for the frame the snapshot came from
+                same_frame = frame is self.curframe and line_number == self.curframe.f_lineno
+                if future.exception() is not None:
+                    log_err(f"Analysis #{analysis_id} failed: {future.exception()}")
+                    continue
+                self._show_analysis(future.result(), offer_commands=same_frame)
+            else:
+                still_running.append(entry)
+        
+        for analysis_id, user_query, *_ in still_running:
+            log_info(f"Still thinking (#{analysis_id}): {user_query}")
+        self._pending = still_running
+
+    def _ollama_unavailable(self) -> bool:
+        """Reports the last connection error while the circuit breaker is open."""
+        remaining = _breaker_remaining()
+        if remaining:
+            log_err(f"Could not connect to Ollama. Is it running? (run `ollama serve`) Retrying in {remaining:.0f}s.")
+        return bool(remaining)
+
+    def _show_analysis(self, analysis: dict, offer_commands: bool = True):
+        """
+        Prints a diagnosis and offers to run the suggested Pdb commands.
+        With offer_commands=False the commands are listed but never executed.
+        """
+        print(_DIAGNOSIS_HEADER)
         print(f"{Colors.BOLD}Diagnosis:{Colors.ENDC} {analysis.get('diagnosis')}")
         print(f"{Colors.BOLD}Fix:{Colors.ENDC}       {analysis.get('suggested_fix')}")
         
@@ -134,12 +431,14 @@ class AIDebugAgent(pdb.Pdb):
             for i, cmd in enumerate(commands, 1):
                 print(f" {i}. {cmd}")
             
-            if self._confirm_action("Execute these commands autonomously?"):
+            if not offer_commands:
+                log_warn("The debugger has moved since this analysis was queued; not running its commands.")
+            elif self._confirm_action("Execute these commands autonomously?"):
                 self._autonomous_drive(commands)
             else:
                 log_info("Skipped autonomous commands.")
         
-        print(f"{Colors.HEADER}======================={Colors.ENDC}\n")
+        print(_DIAGNOSIS_FOOTER)
 
     def _capture_safe_context(self) -> Dict[str, Any]:
         """
@@ -152,47 +451,59 @@ class AIDebugAgent(pdb.Pdb):
         filename = code.co_filename
         
         # 1. Safe Variable Extraction (FIX: Ensures local_vars is defined here)
-        safe_repr = reprlib.Repr()
-        # Ensure config is available or use a hardcoded value for max length
-        max_var_len = getattr(self, 'config', type('obj', (object,), {'MAX_VAR_LEN': 500})()).MAX_VAR_LEN
-        safe_repr.maxstring = max_var_len
-        safe_repr.maxother = max_var_len
-        
-        # This line defines local_vars by safely representing the frame's local variables
-        local_vars = {k: safe_repr.repr(v) for k, v in frame.f_locals.items()} 
+        # This line defines local_vars by safely representing the frame's local variables,
+        # skipping dunders and module/function/class objects before paying for their repr
+        local_vars = {
+            k: _SAFE_REPR.repr(v) for k, v in frame.f_locals.items()
+            if not k.startswith("__") and not isinstance(v, _SKIP_LOCAL_TYPES)
+        }
+        local_vars = _apply_var_budget(local_vars)
         
         
         # 2. Source Code Window
-        snippet = []
         try:
             # Load the file into linecache
             linecache.checkcache(filename)
             
-            # Define the start and end lines for the context window
-            start_line = max(1, lineno - 5)
-            end_line = lineno + 5
+            # Fetch the file once and slice the +/-5 line context window
+            all_lines = linecache.getlines(filename)
+            lo = max(0, lineno - 6)
+            hi = min(len(all_lines), lineno + 5)
             
-            # Retrieve lines from linecache
-            for i in range(start_line, end_line + 1):
-                line = linecache.getline(filename, i)
-                if line:
-                    # Highlight the current line with an arrow for clarity
-                    prefix = "--> " if i == lineno else "    "
-                    snippet.append(f"{prefix}{i}: {line.rstrip()}")
+            # Highlight the current line with an arrow for clarity; long lines
+            # (minified code, data literals) are clipped like variables
+            snippet_str = "\n".join(
+                f"{'--> ' if i == lineno else '    '}{i}: {line.rstrip()[:config.MAX_VAR_LEN]}"
+                for i, line in enumerate(all_lines[lo:hi], start=lo + 1)
+            )
                 
         except Exception as e:
             # Log the source retrieval error, but don't crash the debugger
             # print(f"Warning: Could not retrieve source code for {filename}. Error: {e}", file=sys.stderr)
-            snippet = [f"<Source not available for {filename}>"]
-            
-        snippet_str = "\n".join(snippet)
+            snippet_str = f"<Source not available for {filename}>"
 
         # 3. Exception Info (if post-mortem)
         exc_info = sys.exc_info()
-        exc_str = traceback.format_exception_only(exc_info[0], exc_info[1])[0].strip() if exc_info[0] else "Breakpoint (No Exception)"
+        if exc_info[0] is None:
+            exc_str = "Breakpoint (No Exception)"
+        else:
+            # "module.Type: message" built directly instead of through the traceback formatter;
+            # builtins stay unqualified and the message is dropped when it is empty
+            exc_type = exc_info[0]
+            exc_str = exc_type.__qualname__
+            if exc_type.__module__ not in ("builtins", "__main__"):
+                exc_str = f"{exc_type.__module__}.{exc_str}"
+            try:
+                exc_msg = str(exc_info[1])
+            except Exception:
+                # A broken __str__ must not take down the post-mortem session
+                exc_msg = "<exception str() failed>"
+            if exc_msg:
+                exc_str = f"{exc_str}: {exc_msg}"
 
         # 4. Return the full context (local_vars is now correctly defined)
         return {
+            "filename": filename,
             "function": code.co_name,
             "line_number": lineno,
             "local_variables": local_vars,  # <--- Defined in step 1
@@ -201,7 +512,10 @@ class AIDebugAgent(pdb.Pdb):
         }
 
     def _confirm_action(self, text: str) -> bool:
-        """Production safeguard: Human-in-the-loop confirmation."""
+        """Production safeguard: Human-in-the-loop confirmation (bypassed by AID_AUTO_APPROVE=1)."""
+        if config.AUTO_APPROVE:
+            log_warn(f"{text} Auto-approved (AID_AUTO_APPROVE=1).")
+            return True
         response = input(f"{Colors.WARNING}⚠️  {text} [y/N]: {Colors.ENDC}")
         return response.strip().lower() == 'y'
 